@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
 
+import functools
 import torch
 # YOLO series
 from .yolov1.build import build_yolov1
@@ -13,6 +14,52 @@ from .yolov8.build import build_yolov8
 from .yolox.build import build_yolox
 
 
+# model name -> detector builder
+_BUILDERS = {
+    # YOLOv1
+    'yolov1': build_yolov1,
+    # YOLOv2
+    'yolov2': build_yolov2,
+    # YOLOv3
+    'yolov3': build_yolov3, 'yolov3_tiny': build_yolov3,
+    # YOLOv4
+    'yolov4': build_yolov4, 'yolov4_tiny': build_yolov4,
+    # YOLOv5
+    'yolov5_n': build_yolov5, 'yolov5_s': build_yolov5, 'yolov5_m': build_yolov5,
+    'yolov5_l': build_yolov5, 'yolov5_x': build_yolov5,
+    # YOLOv5-AdamW
+    'yolov5_n_adamw': build_yolov5, 'yolov5_s_adamw': build_yolov5, 'yolov5_m_adamw': build_yolov5,
+    'yolov5_l_adamw': build_yolov5, 'yolov5_x_adamw': build_yolov5,
+    # YOLOv7
+    'yolov7_tiny': build_yolov7, 'yolov7': build_yolov7, 'yolov7_x': build_yolov7,
+    # YOLOv8
+    'yolov8_n': build_yolov8, 'yolov8_s': build_yolov8, 'yolov8_m': build_yolov8,
+    'yolov8_l': build_yolov8, 'yolov8_x': build_yolov8,
+    # YOLOX
+    'yolox_n': build_yolox, 'yolox_s': build_yolox, 'yolox_m': build_yolox,
+    'yolox_l': build_yolox, 'yolox_x': build_yolox,
+    # YOLOX-AdamW
+    'yolox_n_adamw': build_yolox, 'yolox_s_adamw': build_yolox, 'yolox_m_adamw': build_yolox,
+    'yolox_l_adamw': build_yolox, 'yolox_x_adamw': build_yolox,
+}
+
+
+# load the model state dict of a pretrained checkpoint
+def _load_pretrained_state_dict(path):
+    return torch.load(path, map_location='cpu').pop("model")
+
+# cached version, shared across build_model calls in one process.
+# Opt-in for programmatic callers (e.g. sweep/HPO drivers that call build_model in a loop)
+# by setting args.cache_pretrained = True.
+@functools.lru_cache(maxsize=None)
+def _load_pretrained_state_dict_cached(path):
+    """
+        The returned state dict is shared by all the callers, so do not modify it in place.
+        Call _load_pretrained_state_dict_cached.cache_clear() to release the cached weights.
+    """
+    return _load_pretrained_state_dict(path)
+
+
 # build object detector
 def build_model(args, 
                 model_cfg,
@@ -20,69 +67,32 @@ def build_model(args,
                 num_classes=80, 
                 trainable=False,
                 deploy=False):
-    # YOLOv1    
-    if args.model == 'yolov1':
-        model, criterion = build_yolov1(
-            args, model_cfg, device, num_classes, trainable, deploy)
-    # YOLOv2   
-    elif args.model == 'yolov2':
-        model, criterion = build_yolov2(
-            args, model_cfg, device, num_classes, trainable, deploy)
-    # YOLOv3   
-    elif args.model in ['yolov3', 'yolov3_tiny']:
-        model, criterion = build_yolov3(
-            args, model_cfg, device, num_classes, trainable, deploy)
-    # YOLOv4   
-    elif args.model in ['yolov4', 'yolov4_tiny']:
-        model, criterion = build_yolov4(
-            args, model_cfg, device, num_classes, trainable, deploy)
-    # YOLOv5   
-    elif args.model in ['yolov5_n', 'yolov5_s', 'yolov5_m', 'yolov5_l', 'yolov5_x']:
-        model, criterion = build_yolov5(
-            args, model_cfg, device, num_classes, trainable, deploy)
-    # YOLOv5-AdamW
-    elif args.model in ['yolov5_n_adamw', 'yolov5_s_adamw', 'yolov5_m_adamw', 'yolov5_l_adamw', 'yolov5_x_adamw']:
-        model, criterion = build_yolov5(
-            args, model_cfg, device, num_classes, trainable, deploy)
-    # YOLOv7
-    elif args.model in ['yolov7_tiny', 'yolov7', 'yolov7_x']:
-        model, criterion = build_yolov7(
-            args, model_cfg, device, num_classes, trainable, deploy)
-    # YOLOv8
-    elif args.model in ['yolov8_n', 'yolov8_s', 'yolov8_m', 'yolov8_l', 'yolov8_x']:
-        model, criterion = build_yolov8(
-            args, model_cfg, device, num_classes, trainable, deploy)
-    # YOLOX
-    elif args.model in ['yolox_n', 'yolox_s', 'yolox_m', 'yolox_l', 'yolox_x']:
-        model, criterion = build_yolox(
-            args, model_cfg, device, num_classes, trainable, deploy)
-    # YOLOX-AdamW
-    elif args.model in ['yolox_n_adamw', 'yolox_s_adamw', 'yolox_m_adamw', 'yolox_l_adamw', 'yolox_x_adamw']:
-        model, criterion = build_yolox(
-            args, model_cfg, device, num_classes, trainable, deploy)
+    if args.model not in _BUILDERS:
+        raise NotImplementedError("Unknown model: {}".format(args.model))
+    model, criterion = _BUILDERS[args.model](
+        args, model_cfg, device, num_classes, trainable, deploy)
 
     if trainable:
         # Load pretrained weight
         if args.pretrained is not None:
             print('Loading COCO pretrained weight ...')
-            checkpoint = torch.load(args.pretrained, map_location='cpu')
             # checkpoint state dict
-            checkpoint_state_dict = checkpoint.pop("model")
+            if getattr(args, 'cache_pretrained', False):
+                checkpoint_state_dict = _load_pretrained_state_dict_cached(args.pretrained)
+            else:
+                checkpoint_state_dict = _load_pretrained_state_dict(args.pretrained)
             # model state dict
             model_state_dict = model.state_dict()
             # check
-            for k in list(checkpoint_state_dict.keys()):
-                if k in model_state_dict:
-                    shape_model = tuple(model_state_dict[k].shape)
-                    shape_checkpoint = tuple(checkpoint_state_dict[k].shape)
-                    if shape_model != shape_checkpoint:
-                        checkpoint_state_dict.pop(k)
-                        print(k)
-                else:
-                    checkpoint_state_dict.pop(k)
+            filtered_state_dict = {k: v for k, v in checkpoint_state_dict.items()
+                                   if k in model_state_dict and model_state_dict[k].shape == v.shape}
+            # print the skipped keys
+            for k in checkpoint_state_dict:
+                if k not in filtered_state_dict:
                     print(k)
 
-            model.load_state_dict(checkpoint_state_dict, strict=False)
+            model.load_state_dict(filtered_state_dict, strict=False)
+            del checkpoint_state_dict, filtered_state_dict
 
         # keep training
         if args.resume and args.resume != "None":
@@ -79,8 +79,9 @@ class Criterion(object):
         """
         bs = outputs['pred_cls'][0].shape[0]
         device = outputs['pred_cls'][0].device
-        fpn_strides = outputs['strides']
-        anchors = outputs['anchors']
+        anchors = torch.cat(outputs['anchors'], dim=0)                 # [M, 2]
+        stride_tensors = torch.cat(outputs['stride_tensors'], dim=0)   # [M, 1]
+        num_anchors = anchors.shape[0]
         # preds: [B, M, C]
         obj_preds = torch.cat(outputs['pred_obj'], dim=1)
         cls_preds = torch.cat(outputs['pred_cls'], dim=1)
@@ -89,8 +90,8 @@ class Criterion(object):
         # label assignment
         cls_targets = []
         box_targets = []
-        obj_targets = []
-        fg_masks = []
+        obj_targets = obj_preds.new_empty((bs, num_anchors, 1))
+        fg_masks = obj_preds.new_empty((bs, num_anchors), dtype=torch.bool)
 
         for batch_idx in range(bs):
             tgt_labels = targets[batch_idx]["labels"].to(device)
@@ -98,7 +99,6 @@ class Criterion(object):
 
             # check target
             if len(tgt_labels) == 0 or tgt_bboxes.max().item() == 0.:
-                num_anchors = sum([ab.shape[0] for ab in anchors])
                 # There is no valid gt
                 cls_target = obj_preds.new_zeros((0, self.num_classes))
                 box_target = obj_preds.new_zeros((0, 4))
@@ -111,8 +111,8 @@ class Criterion(object):
                     assigned_ious,
                     assigned_indexs
                 ) = self.matcher(
-                    fpn_strides = fpn_strides,
                     anchors = anchors,
+                    stride_tensors = stride_tensors,
                     pred_obj = obj_preds[batch_idx],
                     pred_cls = cls_preds[batch_idx], 
                     pred_box = box_preds[batch_idx],
@@ -127,13 +127,13 @@ class Criterion(object):
 
             cls_targets.append(cls_target)
             box_targets.append(box_target)
-            obj_targets.append(obj_target)
-            fg_masks.append(fg_mask)
+            obj_targets[batch_idx] = obj_target
+            fg_masks[batch_idx] = fg_mask
 
         cls_targets = torch.cat(cls_targets, 0)
         box_targets = torch.cat(box_targets, 0)
-        obj_targets = torch.cat(obj_targets, 0)
-        fg_masks = torch.cat(fg_masks, 0)
+        obj_targets = obj_targets.view(-1, 1)
+        fg_masks = fg_masks.view(-1)
         num_fgs = fg_masks.sum()
 
         if is_dist_avail_and_initialized():
@@ -165,12 +165,12 @@ class Criterion(object):
             ## reg_preds
             reg_preds = torch.cat(outputs['pred_reg'], dim=1)
             reg_preds_pos = reg_preds.view(-1, 4)[fg_masks]
+            ## anchor index of each fg sample: [BM,] -> [Np,]
+            fg_anc_idx = fg_masks.nonzero(as_tuple=False).squeeze(1) % num_anchors
             ## anchor tensors
-            anchors_tensors = torch.cat(outputs['anchors'], dim=0)[None].repeat(bs, 1, 1)
-            anchors_tensors_pos = anchors_tensors.view(-1, 2)[fg_masks]
+            anchors_tensors_pos = anchors.index_select(0, fg_anc_idx)
             ## stride tensors
-            stride_tensors = torch.cat(outputs['stride_tensors'], dim=0)[None].repeat(bs, 1, 1)
-            stride_tensors_pos = stride_tensors.view(-1, 1)[fg_masks]
+            stride_tensors_pos = stride_tensors.index_select(0, fg_anc_idx)
             ## aux loss
             loss_box_aux = self.loss_bboxes_aux(reg_preds_pos, box_targets, anchors_tensors_pos, stride_tensors_pos)
             loss_box_aux = loss_box_aux.sum() / num_fgs
@@ -1,13 +1,47 @@
+from typing import Optional
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
 
-from utils.box_ops import bbox2dist, bbox_iou
+from utils.box_ops import bbox2dist, bbox_ciou
 from utils.distributed_utils import get_world_size, is_dist_avail_and_initialized
 
 from .matcher import TaskAlignedAssigner
 
 
+# scripted to fuse the elementwise ops of the dfl
+@torch.jit.script
+def dfl_loss(pred_reg, gt_box, anchor, stride, reg_max: int, bbox_weight: Optional[torch.Tensor] = None):
+    # rescale coords by stride
+    inv_stride = stride.reciprocal()
+    gt_box_s = gt_box * inv_stride
+    anchor_s = anchor * inv_stride
+
+    # compute deltas
+    gt_ltrb_s = bbox2dist(anchor_s, gt_box_s, reg_max - 1)
+
+    gt_left = gt_ltrb_s.to(torch.long)
+    gt_right = gt_left + 1
+
+    weight_left = gt_right.to(torch.float) - gt_ltrb_s
+    weight_right = 1 - weight_left
+
+    # log-probs of the DFL bins, shared by the left & right targets
+    logp = F.log_softmax(pred_reg.view(-1, reg_max), dim=-1)
+    # loss left
+    loss_left = -logp.gather(1, gt_left.view(-1, 1)).view(gt_left.shape) * weight_left
+    # loss right
+    loss_right = -logp.gather(1, gt_right.view(-1, 1)).view(gt_left.shape) * weight_right
+
+    loss_dfl = (loss_left + loss_right).mean(-1)
+    
+    if bbox_weight is not None:
+        loss_dfl *= bbox_weight
+
+    return loss_dfl
+
+
 class Criterion(object):
     def __init__(self, cfg, device, num_classes=80):
         # --------------- Basic parameters ---------------
@@ -28,49 +62,20 @@ class Criterion(object):
                                            )
 
     def loss_classes(self, pred_cls, gt_score):
-        # compute bce loss
-        loss_cls = F.binary_cross_entropy_with_logits(pred_cls, gt_score, reduction='none')
+        # compute bce loss, summed over all the samples
+        loss_cls = F.binary_cross_entropy_with_logits(pred_cls, gt_score, reduction='sum')
 
         return loss_cls
     
     def loss_bboxes(self, pred_box, gt_box, bbox_weight):
         # regression loss
-        ious = bbox_iou(pred_box, gt_box, xywh=False, CIoU=True)
-        loss_box = (1.0 - ious.squeeze(-1)) * bbox_weight
+        ious = bbox_ciou(pred_box, gt_box)
+        loss_box = (1.0 - ious) * bbox_weight
 
         return loss_box
     
     def loss_dfl(self, pred_reg, gt_box, anchor, stride, bbox_weight=None):
-        # rescale coords by stride
-        gt_box_s = gt_box / stride
-        anchor_s = anchor / stride
-
-        # compute deltas
-        gt_ltrb_s = bbox2dist(anchor_s, gt_box_s, self.cfg['reg_max'] - 1)
-
-        gt_left = gt_ltrb_s.to(torch.long)
-        gt_right = gt_left + 1
-
-        weight_left = gt_right.to(torch.float) - gt_ltrb_s
-        weight_right = 1 - weight_left
-
-        # loss left
-        loss_left = F.cross_entropy(
-            pred_reg.view(-1, self.cfg['reg_max']),
-            gt_left.view(-1),
-            reduction='none').view(gt_left.shape) * weight_left
-        # loss right
-        loss_right = F.cross_entropy(
-            pred_reg.view(-1, self.cfg['reg_max']),
-            gt_right.view(-1),
-            reduction='none').view(gt_left.shape) * weight_right
-
-        loss_dfl = (loss_left + loss_right).mean(-1)
-        
-        if bbox_weight is not None:
-            loss_dfl *= bbox_weight
-
-        return loss_dfl
+        return dfl_loss(pred_reg, gt_box, anchor, stride, self.cfg['reg_max'], bbox_weight)
 
     def __call__(self, outputs, targets, epoch=0):        
         """
@@ -86,9 +91,8 @@ class Criterion(object):
         """
         bs = outputs['pred_cls'][0].shape[0]
         device = outputs['pred_cls'][0].device
-        strides = outputs['stride_tensor']
-        anchors = outputs['anchors']
-        anchors = torch.cat(anchors, dim=0)
+        anchors = torch.cat(outputs['anchors'], dim=0)         # [M, 2]
+        strides = torch.cat(outputs['stride_tensor'], dim=0)   # [M, 1]
         num_anchors = anchors.shape[0]
 
         # preds: [B, M, C]
@@ -97,44 +101,49 @@ class Criterion(object):
         box_preds = torch.cat(outputs['pred_box'], dim=1)
         
         # --------------- label assignment ---------------
-        gt_score_targets = []
-        gt_bbox_targets = []
-        fg_masks = []
-        for batch_idx in range(bs):
-            tgt_labels = targets[batch_idx]["labels"].to(device)     # [Mp,]
-            tgt_boxs = targets[batch_idx]["boxes"].to(device)        # [Mp, 4]
-
-            # check target
-            if len(tgt_labels) == 0 or tgt_boxs.max().item() == 0.:
-                # There is no valid gt
-                fg_mask = cls_preds.new_zeros(1, num_anchors).bool()               #[1, M,]
-                gt_score = cls_preds.new_zeros((1, num_anchors, self.num_classes)) #[1, M, C]
-                gt_box = cls_preds.new_zeros((1, num_anchors, 4))                  #[1, M, 4]
-            else:
-                tgt_labels = tgt_labels[None, :, None]      # [1, Mp, 1]
-                tgt_boxs = tgt_boxs[None]                   # [1, Mp, 4]
-                (
-                    _,
-                    gt_box,     # [1, M, 4]
-                    gt_score,   # [1, M, C]
-                    fg_mask,    # [1, M,]
-                    _
-                ) = self.matcher(
-                    pd_scores = cls_preds[batch_idx:batch_idx+1].detach().sigmoid(), 
-                    pd_bboxes = box_preds[batch_idx:batch_idx+1].detach(),
-                    anc_points = anchors,
-                    gt_labels = tgt_labels,
-                    gt_bboxes = tgt_boxs
-                    )
-            gt_score_targets.append(gt_score)
-            gt_bbox_targets.append(gt_box)
-            fg_masks.append(fg_mask)
-
-        # List[B, 1, M, C] -> Tensor[B, M, C] -> Tensor[BM, C]
-        fg_masks = torch.cat(fg_masks, 0).view(-1)                                    # [BM,]
-        gt_score_targets = torch.cat(gt_score_targets, 0).view(-1, self.num_classes)  # [BM, C]
-        gt_bbox_targets = torch.cat(gt_bbox_targets, 0).view(-1, 4)                   # [BM, 4]
-        num_fgs = gt_score_targets.sum()
+        ## detached preds of the whole batch for the matcher: [B, M, C], [B, M, 4]
+        pd_scores = cls_preds.detach().sigmoid()
+        pd_bboxes = box_preds.detach()
+
+        ## pad the targets of each image to [B, Mp, ...] on the host
+        gt_labels = pad_sequence([tgt["labels"] for tgt in targets], batch_first=True)  # [B, Mp]
+        gt_labels = gt_labels.long()[..., None]                                          # [B, Mp, 1]
+        gt_bboxes = pad_sequence([tgt["boxes"] for tgt in targets], batch_first=True)   # [B, Mp, 4]
+        # check target: the padded and the all-zero boxes are not valid gts
+        mask_gt = gt_bboxes.amax(-1, keepdim=True) > 0.                                  # [B, Mp, 1]
+
+        ## move them to the device with a single non-blocking copy per tensor
+        if device.type == 'cuda':
+            gt_labels = gt_labels.pin_memory()
+            gt_bboxes = gt_bboxes.pin_memory()
+            mask_gt = mask_gt.pin_memory()
+        gt_labels = gt_labels.to(device, non_blocking=True)
+        gt_bboxes = gt_bboxes.to(device, non_blocking=True)
+        mask_gt = mask_gt.to(device, non_blocking=True)
+
+        (
+            _,
+            gt_bbox_targets,   # [B, M, 4]
+            gt_score_targets,  # [B, M, C]
+            fg_masks,          # [B, M,]
+            _
+        ) = self.matcher(
+            pd_scores = pd_scores,
+            pd_bboxes = pd_bboxes,
+            anc_points = anchors,
+            gt_labels = gt_labels,
+            gt_bboxes = gt_bboxes,
+            mask_gt = mask_gt
+            )
+
+        # Tensor[B, M, C] -> Tensor[BM, C]
+        fg_masks = fg_masks.view(-1)                                        # [BM,]
+        gt_score_targets = gt_score_targets.view(-1, self.num_classes)      # [BM, C]
+        gt_bbox_targets = gt_bbox_targets.view(-1, 4)                       # [BM, 4]
+        fg_idx = fg_masks.nonzero(as_tuple=False).squeeze(1)                # [Np,]
+        # the target scores are zero outside the fg samples
+        bbox_weight = gt_score_targets.index_select(0, fg_idx).sum(-1)      # [Np,]
+        num_fgs = bbox_weight.sum()
         
         # Average loss normalizer across all the GPUs
         if is_dist_avail_and_initialized():
@@ -144,26 +153,24 @@ class Criterion(object):
         # ------------------ Classification loss ------------------
         cls_preds = cls_preds.view(-1, self.num_classes)
         loss_cls = self.loss_classes(cls_preds, gt_score_targets)
-        loss_cls = loss_cls.sum() / num_fgs
+        loss_cls = loss_cls / num_fgs
 
         # ------------------ Regression loss ------------------
-        box_preds_pos = box_preds.view(-1, 4)[fg_masks]
-        box_targets_pos = gt_bbox_targets.view(-1, 4)[fg_masks]
-        bbox_weight = gt_score_targets[fg_masks].sum(-1)
+        ## Without any fg sample, the box & dfl losses below run on empty tensors and
+        ## give a zero that stays connected to the reg branch (required by DDP),
+        ## so this case needs no special zero-loss branch.
+        box_preds_pos = box_preds.view(-1, 4).index_select(0, fg_idx)
+        box_targets_pos = gt_bbox_targets.index_select(0, fg_idx)
         loss_box = self.loss_bboxes(box_preds_pos, box_targets_pos, bbox_weight)
         loss_box = loss_box.sum() / num_fgs
 
         # ------------------ Distribution focal loss  ------------------
-        ## process anchors
-        anchors = torch.cat(outputs['anchors'], dim=0)
-        anchors = anchors[None].repeat(bs, 1, 1).view(-1, 2)
-        ## process stride tensors
-        strides = torch.cat(outputs['stride_tensor'], dim=0)
-        strides = strides.unsqueeze(0).repeat(bs, 1, 1).view(-1, 1)
+        ## anchor index of each fg sample: [Np,]
+        anc_idx = fg_idx % num_anchors
         ## fg preds
-        reg_preds_pos = reg_preds.view(-1, 4*self.cfg['reg_max'])[fg_masks]
-        anchors_pos = anchors[fg_masks]
-        strides_pos = strides[fg_masks]
+        reg_preds_pos = reg_preds.view(-1, 4*self.cfg['reg_max']).index_select(0, fg_idx)
+        anchors_pos = anchors.index_select(0, anc_idx)
+        strides_pos = strides.index_select(0, anc_idx)
         ## compute dfl
         loss_dfl = self.loss_dfl(reg_preds_pos, box_targets_pos, anchors_pos, strides_pos, bbox_weight)
         loss_dfl = loss_dfl.sum() / num_fgs
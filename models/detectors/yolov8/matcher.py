@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from utils.box_ops import bbox_iou
+from utils.box_ops import bbox_ciou
 
 
 # -------------------------- Task Aligned Assigner --------------------------
@@ -26,12 +26,21 @@ class TaskAlignedAssigner(nn.Module):
                 pd_bboxes,
                 anc_points,
                 gt_labels,
-                gt_bboxes):
+                gt_bboxes,
+                mask_gt):
         self.bs = pd_scores.size(0)
         self.n_max_boxes = gt_bboxes.size(1)
 
+        # There is no gt in the whole batch
+        if self.n_max_boxes == 0:
+            return (torch.full_like(pd_scores[..., 0], self.bg_idx).long(),
+                    torch.zeros_like(pd_bboxes),
+                    torch.zeros_like(pd_scores),
+                    torch.zeros_like(pd_scores[..., 0]).bool(),
+                    torch.zeros_like(pd_scores[..., 0]).long())
+
         mask_pos, align_metric, overlaps = self.get_pos_mask(
-            pd_scores, pd_bboxes, gt_labels, gt_bboxes, anc_points)
+            pd_scores, pd_bboxes, gt_labels, gt_bboxes, anc_points, mask_gt)
 
         target_gt_idx, fg_mask, mask_pos = select_highest_overlaps(
             mask_pos, overlaps, self.n_max_boxes)
@@ -49,9 +58,9 @@ class TaskAlignedAssigner(nn.Module):
 
         return target_labels, target_bboxes, target_scores, fg_mask.bool(), target_gt_idx
 
-    def get_pos_mask(self, pd_scores, pd_bboxes, gt_labels, gt_bboxes, anc_points):
+    def get_pos_mask(self, pd_scores, pd_bboxes, gt_labels, gt_bboxes, anc_points, mask_gt):
         # get in_gts mask, (b, max_num_obj, h*w)
-        mask_in_gts = select_candidates_in_gts(anc_points, gt_bboxes)
+        mask_in_gts = select_candidates_in_gts(anc_points, gt_bboxes) * mask_gt
         # get anchor_align metric, (b, max_num_obj, h*w)
         align_metric, overlaps = self.get_box_metrics(pd_scores, pd_bboxes, gt_labels, gt_bboxes, mask_in_gts)
         # get topk_metric mask, (b, max_num_obj, h*w)
@@ -68,16 +77,16 @@ class TaskAlignedAssigner(nn.Module):
         overlaps = torch.zeros([self.bs, self.n_max_boxes, na], dtype=pd_bboxes.dtype, device=pd_bboxes.device)
         bbox_scores = torch.zeros([self.bs, self.n_max_boxes, na], dtype=pd_scores.dtype, device=pd_scores.device)
 
-        ind = torch.zeros([2, self.bs, self.n_max_boxes], dtype=torch.long)  # 2, b, max_num_obj
-        ind[0] = torch.arange(end=self.bs).view(-1, 1).expand(-1, self.n_max_boxes)  # b, max_num_obj
-        ind[1] = gt_labels.squeeze(-1)  # b, max_num_obj
+        # indexes of the in-gt pairs: (b, max_num_obj, h*w) -> 3 x [N,]
+        b_idx, gt_idx, anc_idx = mask_in_gts.nonzero(as_tuple=True)
+        gt_cls = gt_labels.squeeze(-1)[b_idx, gt_idx]  # [N,]
         # Get the scores of each grid for each gt cls
-        bbox_scores[mask_in_gts] = pd_scores[ind[0], :, ind[1]][mask_in_gts]  # b, max_num_obj, h*w
+        bbox_scores[b_idx, gt_idx, anc_idx] = pd_scores[b_idx, anc_idx, gt_cls]  # b, max_num_obj, h*w
 
-        # (b, max_num_obj, 1, 4), (b, 1, h*w, 4)
-        pd_boxes = pd_bboxes.unsqueeze(1).expand(-1, self.n_max_boxes, -1, -1)[mask_in_gts]
-        gt_boxes = gt_bboxes.unsqueeze(2).expand(-1, -1, na, -1)[mask_in_gts]
-        overlaps[mask_in_gts] = bbox_iou(gt_boxes, pd_boxes, xywh=False, CIoU=True).squeeze(-1).clamp_(0)
+        # [N, 4], [N, 4]
+        pd_boxes = pd_bboxes[b_idx, anc_idx]
+        gt_boxes = gt_bboxes[b_idx, gt_idx]
+        overlaps[b_idx, gt_idx, anc_idx] = bbox_ciou(gt_boxes, pd_boxes).clamp_(0)
 
         align_metric = bbox_scores.pow(self.alpha) * overlaps.pow(self.beta)
         return align_metric, overlaps
@@ -124,7 +133,7 @@ class TaskAlignedAssigner(nn.Module):
                                     device=target_labels.device)  # (b, h*w, 80)
         target_scores.scatter_(2, target_labels.unsqueeze(-1), 1)
 
-        fg_scores_mask = fg_mask[:, :, None].repeat(1, 1, self.num_classes)  # (b, h*w, 80)
+        fg_scores_mask = fg_mask[:, :, None]  # (b, h*w, 1), broadcast over the classes
         target_scores = torch.where(fg_scores_mask > 0, target_scores, 0)
 
         return target_labels, target_bboxes, target_scores
@@ -142,9 +151,10 @@ def select_candidates_in_gts(xy_centers, gt_bboxes, eps=1e-9):
     n_anchors = xy_centers.size(0)
     bs, n_max_boxes, _ = gt_bboxes.size()
     _gt_bboxes = gt_bboxes.reshape([-1, 4])
-    xy_centers = xy_centers.unsqueeze(0).repeat(bs * n_max_boxes, 1, 1)
-    gt_bboxes_lt = _gt_bboxes[:, 0:2].unsqueeze(1).repeat(1, n_anchors, 1)
-    gt_bboxes_rb = _gt_bboxes[:, 2:4].unsqueeze(1).repeat(1, n_anchors, 1)
+    # (1, num_total_anchors, 2) & (bs*n_max_boxes, 1, 2), broadcast in the deltas
+    xy_centers = xy_centers.unsqueeze(0)
+    gt_bboxes_lt = _gt_bboxes[:, 0:2].unsqueeze(1)
+    gt_bboxes_rb = _gt_bboxes[:, 2:4].unsqueeze(1)
     b_lt = xy_centers - gt_bboxes_lt
     b_rb = gt_bboxes_rb - xy_centers
     bbox_deltas = torch.cat([b_lt, b_rb], dim=-1)
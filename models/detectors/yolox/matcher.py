@@ -20,18 +20,15 @@ class SimOTA(object):
 
     @torch.no_grad()
     def __call__(self, 
-                 fpn_strides, 
                  anchors, 
+                 stride_tensors, 
                  pred_obj, 
                  pred_cls, 
                  pred_box, 
                  tgt_labels,
                  tgt_bboxes):
-        # [M,]
-        strides_tensor = torch.cat([torch.ones_like(anchor_i[:, 0]) * stride_i
-                                for stride_i, anchor_i in zip(fpn_strides, anchors)], dim=-1)
-        # List[F, M, 2] -> [M, 2]
-        anchors = torch.cat(anchors, dim=0)
+        # [M, 1] -> [M,]
+        strides_tensor = stride_tensors.squeeze(-1)
         num_anchor = anchors.shape[0]        
         num_gt = len(tgt_labels)
 
@@ -34,7 +34,7 @@ def rescale_bboxes(bboxes, origin_size, ratio):
 
     return bboxes
 
-def bbox2dist(anchor_points, bbox, reg_max):
+def bbox2dist(anchor_points, bbox, reg_max: int):
     '''Transform bbox(xyxy) to dist(ltrb).'''
     x1y1, x2y2 = torch.split(bbox, 2, -1)
     lt = anchor_points - x1y1
@@ -199,6 +199,38 @@ def bbox_iou(box1, box2, xywh=True, GIoU=False, DIoU=False, CIoU=False, eps=1e-7
     return iou  # IoU
 
 
+@torch.jit.script
+def bbox_ciou(box1, box2, eps: float = 1e-7):
+    # Returns Complete IoU (CIoU) of box1(n,4) to box2(n,4), both in xyxy format.
+    # Same as bbox_iou(box1, box2, xywh=False, CIoU=True).squeeze(-1), specialized for the losses.
+    b1_x1, b1_y1, b1_x2, b1_y2 = box1.unbind(-1)
+    b2_x1, b2_y1, b2_x2, b2_y2 = box2.unbind(-1)
+    w1, h1 = b1_x2 - b1_x1, b1_y2 - b1_y1 + eps
+    w2, h2 = b2_x2 - b2_x1, b2_y2 - b2_y1 + eps
+
+    # Intersection area
+    inter = (torch.minimum(b1_x2, b2_x2) - torch.maximum(b1_x1, b2_x1)).clamp_min_(0) * \
+            (torch.minimum(b1_y2, b2_y2) - torch.maximum(b1_y1, b2_y1)).clamp_min_(0)
+
+    # Union Area
+    union = w1 * h1 + w2 * h2 - inter + eps
+
+    # IoU
+    iou = inter / union
+
+    # Distance term
+    cw = torch.maximum(b1_x2, b2_x2) - torch.minimum(b1_x1, b2_x1)  # convex (smallest enclosing box) width
+    ch = torch.maximum(b1_y2, b2_y2) - torch.minimum(b1_y1, b2_y1)  # convex height
+    c2 = cw ** 2 + ch ** 2 + eps  # convex diagonal squared
+    rho2 = ((b2_x1 + b2_x2 - b1_x1 - b1_x2) ** 2 + (b2_y1 + b2_y2 - b1_y1 - b1_y2) ** 2) / 4  # center dist ** 2
+
+    # Aspect ratio term
+    v = (4 / math.pi ** 2) * (torch.atan(w2 / h2) - torch.atan(w1 / h1)).pow(2)
+    alpha = (v / (v - iou + (1 + eps))).detach()
+
+    return iou - (rho2 / c2 + v * alpha)  # CIoU
+
+
 if __name__ == '__main__':
     box1 = torch.tensor([[10, 10, 20, 20]])
     box2 = torch.tensor([[15, 15, 20, 20]])